@@ -1,16 +1,294 @@
+import time
+_process_started = time.perf_counter()
+
 import os
 import json
+import gzip
+import hashlib
+import heapq
+import hmac
 import random
+import re
+import signal
+import sqlite3
+import sys
+import threading
+import unicodedata
+import cProfile
+import pstats
+from collections import Counter, OrderedDict, deque
 import nltk
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.utils.data import DataLoader, TensorDataset
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 # Import for sentence-transformers
-from sentence_transformers import SentenceTransformer, util
+from sentence_transformers import SentenceTransformer
+
+IMPORT_SECONDS = time.perf_counter() - _process_started
+
+# Brotli is optional; gzip is always available
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Language detection is optional; without it every message uses the default encoder
+try:
+    from langdetect import DetectorFactory, detect as detect_language
+    DetectorFactory.seed = 0
+except ImportError:
+    detect_language = None
+
+# Minimum similarity for an intent match before falling back to the internet
+CONFIDENCE_THRESHOLD = 0.4
+
+# Payloads smaller than this are sent uncompressed
+COMPRESSION_MIN_SIZE = 512
+
+# Admin endpoints (profiling, metrics) are disabled unless a token is set
+PROFILE_ADMIN_TOKEN = os.environ.get("PROFILE_ADMIN_TOKEN", "")
+PROFILE_OUTPUT_DIR = os.environ.get("PROFILE_OUTPUT_DIR", "profiles")
+PROFILE_SIGNAL = os.environ.get("PROFILE_SIGNAL", "") == "1"
+PROFILE_SIGNAL_SECONDS = float(os.environ.get("PROFILE_SIGNAL_SECONDS", "30"))
+
+# Input limits applied before encoding
+MAX_INPUT_CHARS = int(os.environ.get("MAX_INPUT_CHARS", "2000"))
+MAX_INPUT_SENTENCES = int(os.environ.get("MAX_INPUT_SENTENCES", "8"))  # segments encoded per message
+MAX_REQUEST_BYTES = int(os.environ.get("MAX_REQUEST_BYTES", "65536"))
+
+# Set to e.g. 'paraphrase-multilingual-MiniLM-L12-v2' to route non-English input
+MULTILINGUAL_MODEL = os.environ.get("MULTILINGUAL_MODEL", "")
+
+# Per-client token bucket; backend is 'memory' or 'sqlite' (shared across local workers)
+RATE_LIMIT_PER_SECOND = float(os.environ.get("RATE_LIMIT_PER_SECOND", "2"))
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", "10"))
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_SQLITE_PATH = os.environ.get("RATE_LIMIT_SQLITE_PATH", "ratelimit.sqlite3")
+# Number of reverse proxies (e.g. ngrok) in front of the app whose X-Forwarded-For is trusted
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", "0"))
+# Idle buckets that have refilled to the burst are dropped this often (seconds)
+RATE_LIMIT_PRUNE_INTERVAL = float(os.environ.get("RATE_LIMIT_PRUNE_INTERVAL", "60"))
+
+# Fair scheduling in front of the encoder
+ENCODER_CONCURRENCY = int(os.environ.get("ENCODER_CONCURRENCY", "2"))
+CLIENT_QUEUE_DEPTH = int(os.environ.get("CLIENT_QUEUE_DEPTH", "4"))
+QUEUE_TIMEOUT = float(os.environ.get("QUEUE_TIMEOUT", "10"))
+
+# Normalized messages whose intent match is remembered (skips the encoder)
+MATCH_CACHE_SIZE = int(os.environ.get("MATCH_CACHE_SIZE", "1024"))
+
+# Pattern index storage: 'float32' or 'int8'; INDEX_PCA_DIM=0 keeps full width
+INDEX_DTYPE = os.environ.get("INDEX_DTYPE", "float32")
+INDEX_PCA_DIM = int(os.environ.get("INDEX_PCA_DIM", "0"))
+
+# Startup warm-up before the process reports ready
+WARMUP_ENABLED = os.environ.get("WARMUP_ENABLED", "1") == "1"
+WARMUP_ROUNDS = int(os.environ.get("WARMUP_ROUNDS", "2"))
+
+
+# =====================
+# INPUT NORMALIZATION
+# =====================
+_DROPPED_CATEGORIES = ("Cc", "Cs", "Co")
+
+
+def normalize_message(message):
+    # NFKC folds full-width/compatibility forms; control, surrogate and
+    # private-use chars are dropped. Format chars (Cf) stay: ZWJ/ZWNJ are part
+    # of correct spelling in Persian, Hindi and other scripts.
+    # The raw string is sliced first (with headroom for whitespace that gets
+    # collapsed) so oversized input never reaches the per-character work.
+    text = unicodedata.normalize("NFKC", message[:MAX_INPUT_CHARS * 4])
+    text = "".join(ch for ch in text if ch.isspace() or unicodedata.category(ch) not in _DROPPED_CATEGORIES)
+    return " ".join(text.split())
+
+
+def prepare_message(message):
+    # Returns (text, capped): the normalized text that is cached and encoded,
+    # and whether anything was cut off to fit MAX_INPUT_CHARS
+    cleaned = normalize_message(message)
+    capped = len(cleaned) > MAX_INPUT_CHARS or len(message) > MAX_INPUT_CHARS * 4
+    return cleaned[:MAX_INPUT_CHARS], capped
+
+
+def split_sentences(text):
+    try:
+        sentences = nltk.sent_tokenize(text)
+    except LookupError:
+        # punkt data not downloaded
+        sentences = re.split(r"(?<=[.!?])\s+", text)
+    return [sentence for sentence in sentences if sentence]
+
+
+def _chunk_tokens(tokenizer, ids, window):
+    # Splits token ids into (text, token_count) pieces of at most `window`
+    # tokens, cutting before a word start rather than inside a word, so a
+    # piece never begins with a "##" continuation that would re-tokenize longer
+    tokens = tokenizer.convert_ids_to_tokens(ids)
+    pieces = []
+    start = 0
+    while start < len(tokens):
+        end = min(start + window, len(tokens))
+        cut = end
+        while start + 1 < cut < len(tokens) and tokens[cut].startswith("##"):
+            cut -= 1
+        if cut == len(tokens) or not tokens[cut].startswith("##"):
+            end = cut
+        piece = list(tokens[start:end])
+        # Only reached for a single word longer than the window
+        piece[0] = piece[0][2:] if piece[0].startswith("##") else piece[0]
+        pieces.append((tokenizer.convert_tokens_to_string(piece), end - start))
+        start = end
+    return pieces
+
+
+# =====================
+# PATTERN INDEX
+# =====================
+class IntentIndex:
+    # All pattern embeddings in one matrix, L2-normalized once at build time so
+    # scoring is a single matrix product instead of cos_sim per intent.
+    # Rows can be PCA-projected (fit on the corpus) and stored as int8 with a
+    # per-row scale. int8 is a memory option only: numpy has no int8 BLAS path,
+    # so rows are dequantized to float32 in SCORE_CHUNK_ROWS blocks while
+    # scoring, which is slower than float32 (index_report measures by how
+    # much). Full-precision rows are not kept, so there is no rescoring step.
+    # There is no float16 option: its conversion is slower still.
+
+    DTYPES = ("float32", "int8")
+    SCORE_CHUNK_ROWS = 2048  # bounds the float32 temporary to ~3 MB at 384 dims
+
+    def __init__(self, intent_embeddings, dtype="float32", pca_dim=0):
+        if dtype not in self.DTYPES:
+            raise ValueError("index dtype must be one of %s" % ", ".join(self.DTYPES))
+        self.dtype = dtype
+        self.pca_dim = pca_dim
+        self.tags = list(intent_embeddings)
+        vectors = [np.asarray(intent_embeddings[tag], dtype=np.float32) for tag in self.tags]
+        self.row_intent = np.concatenate([np.full(len(v), i) for i, v in enumerate(vectors)])
+        vectors = np.concatenate(vectors)
+
+        self.mean = None
+        self.components = None
+        if 0 < pca_dim < vectors.shape[1]:
+            if pca_dim > vectors.shape[0]:
+                raise ValueError("pca_dim %d exceeds the %d pattern rows it is fit on"
+                                 % (pca_dim, vectors.shape[0]))
+            self.mean = vectors.mean(axis=0)
+            _, _, vt = np.linalg.svd(vectors - self.mean, full_matrices=False)
+            self.components = np.ascontiguousarray(vt[:pca_dim].T)
+
+        vectors = self.project(vectors)
+        self.scale = None
+        if dtype == "int8":
+            self.scale = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127.0
+            self.matrix = np.round(vectors / self.scale[:, None]).astype(np.int8)
+            self.scale = self.scale.astype(np.float32)
+        else:
+            self.matrix = vectors
+
+    @property
+    def nbytes(self):
+        # Includes the projection, which dominates for small corpora
+        total = self.matrix.nbytes
+        if self.scale is not None:
+            total += self.scale.nbytes
+        if self.components is not None:
+            total += self.components.nbytes + self.mean.nbytes
+        return total
+
+    def project(self, vectors):
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        if self.components is not None:
+            vectors = (vectors - self.mean) @ self.components
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _row_scores(self, queries):
+        # (rows, n_queries) cosine scores for already projected queries
+        if self.dtype != "int8":
+            return self.matrix @ queries.T
+        scores = np.empty((self.matrix.shape[0], queries.shape[0]), dtype=np.float32)
+        for start in range(0, self.matrix.shape[0], self.SCORE_CHUNK_ROWS):
+            block = self.matrix[start:start + self.SCORE_CHUNK_ROWS].astype(np.float32)
+            scores[start:start + self.SCORE_CHUNK_ROWS] = block @ queries.T
+        scores *= self.scale[:, None]
+        return scores
+
+    def search(self, queries):
+        # Best (tag, score) over every query row / pattern row pair
+        scores = self._row_scores(self.project(queries))
+        row, _ = np.unravel_index(np.argmax(scores), scores.shape)
+        return self.tags[self.row_intent[row]], float(scores[row].max())
+
+    def best_matches(self, queries):
+        # Independent best (tag, score) per query row
+        scores = self._row_scores(self.project(queries))
+        best_rows = np.argmax(scores, axis=0)
+        tags = [self.tags[self.row_intent[row]] for row in best_rows]
+        return tags, scores[best_rows, np.arange(scores.shape[1])]
+
+
+def _search_micros(index, queries):
+    # Mean wall time of a single-query search, in microseconds
+    started = time.perf_counter()
+    for query in queries:
+        index.search(query)
+    return (time.perf_counter() - started) / len(queries) * 1e6
+
+
+def index_report(intent_embeddings, index, folds=5):
+    # Held-out accuracy and memory of `index` relative to an uncompressed
+    # float32 index. Each fold's patterns are matched against indexes built
+    # (and PCA-fit) on the other folds, so the projection never sees the
+    # patterns it is scored on.
+    tags = list(intent_embeddings)
+    vectors = np.concatenate([np.asarray(intent_embeddings[tag], dtype=np.float32) for tag in tags])
+    labels = np.concatenate([np.full(len(intent_embeddings[tag]), i) for i, tag in enumerate(tags)])
+    fold_of = np.arange(len(vectors)) % folds
+
+    hits = baseline_hits = flips = 0
+    score_deltas = []
+    for fold in range(folds):
+        train = fold_of != fold
+        train_embeddings = {
+            tag: vectors[train & (labels == i)] for i, tag in enumerate(tags) if np.any(train & (labels == i))
+        }
+        pca_dim = min(index.pca_dim, int(train.sum()))
+        baseline = IntentIndex(train_embeddings)
+        candidate = IntentIndex(train_embeddings, dtype=index.dtype, pca_dim=pca_dim)
+
+        truth = [tags[i] for i in labels[~train]]
+        baseline_tags, baseline_scores = baseline.best_matches(vectors[~train])
+        candidate_tags, candidate_scores = candidate.best_matches(vectors[~train])
+        baseline_hits += sum(t == p for t, p in zip(truth, baseline_tags))
+        hits += sum(t == p for t, p in zip(truth, candidate_tags))
+        flips += int(np.sum((baseline_scores >= CONFIDENCE_THRESHOLD) != (candidate_scores >= CONFIDENCE_THRESHOLD)))
+        score_deltas.append(np.abs(candidate_scores - baseline_scores))
+
+    accuracy = hits / len(vectors)
+    baseline_accuracy = baseline_hits / len(vectors)
+    timing_queries = vectors[:32]
+    return {
+        "dtype": index.dtype,
+        "pca_dim": index.pca_dim,
+        "dim": index.matrix.shape[1],
+        "bytes": index.nbytes,
+        "baseline_bytes": vectors.nbytes,
+        "search_us": round(_search_micros(index, timing_queries), 1),
+        "baseline_search_us": round(_search_micros(IntentIndex(intent_embeddings), timing_queries), 1),
+        "accuracy": round(accuracy, 4),
+        "baseline_accuracy": round(baseline_accuracy, 4),
+        "accuracy_delta": round(accuracy - baseline_accuracy, 4),
+        "mean_abs_score_delta": round(float(np.mean(np.concatenate(score_deltas))), 4),
+        "threshold_flip_rate": round(flips / len(vectors), 4),
+    }
+
 
 # =====================
 # CHATBOT CLASS WITH EMBEDDINGS
@@ -22,16 +300,78 @@ class Chatbot:
         self.patterns = {}
         self.intents = []
 
+        self.startup_timings = {}
+
         # Load intents and precompute embeddings
+        started = time.perf_counter()
         self._load_intents()
+        self.startup_timings["intents_load"] = time.perf_counter() - started
 
         # Load sentence-transformer model
+        started = time.perf_counter()
         self.embed_model = SentenceTransformer('all-MiniLM-L6-v2')
+        self.startup_timings["model_load"] = time.perf_counter() - started
+
+        # Precompute embeddings for all patterns per intent and index them
+        self.intent_index, self.index_report = self._build_index(self.embed_model)
+
+        # Optional multilingual encoder with its own pattern index
+        self.multilingual_model = None
+        self.multilingual_index = None
+        if MULTILINGUAL_MODEL and detect_language is not None:
+            started = time.perf_counter()
+            self.multilingual_model = SentenceTransformer(MULTILINGUAL_MODEL)
+            self.startup_timings["multilingual_model_load"] = time.perf_counter() - started
+            self.multilingual_index, _ = self._build_index(self.multilingual_model, "multilingual_", report=False)
+
+        # Encoding cost accounting (characters, tokens, segments encoded)
+        self.input_stats = Counter()
+        self._input_stats_lock = threading.Lock()
+
+        # LRU of normalized message -> (tag, score)
+        self._match_cache = OrderedDict()
+        self._match_cache_lock = threading.Lock()
+
+        # Pre-serialize every canned response once so /chat never builds JSON for them
+        self._build_response_payloads()
 
-        # Precompute embeddings for all patterns per intent
-        self.intent_embeddings = {}
+    def _embed_patterns(self, encoder):
+        embeddings = {}
         for tag, patterns_list in self.patterns.items():
-            self.intent_embeddings[tag] = self.embed_model.encode(patterns_list, convert_to_tensor=True)
+            embeddings[tag] = encoder.encode(patterns_list)
+        return embeddings
+
+    def _build_index(self, encoder, timing_prefix="", report=True):
+        # The full-precision embeddings are only kept long enough to measure
+        # what the configured storage costs in accuracy
+        started = time.perf_counter()
+        embeddings = self._embed_patterns(encoder)
+        self.startup_timings[timing_prefix + "corpus_embedding"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        index = IntentIndex(embeddings, dtype=INDEX_DTYPE, pca_dim=INDEX_PCA_DIM)
+        self.startup_timings[timing_prefix + "index_build"] = time.perf_counter() - started
+        if not report:
+            return index, None
+
+        started = time.perf_counter()
+        index_stats = index_report(embeddings, index)
+        self.startup_timings[timing_prefix + "index_report"] = time.perf_counter() - started
+        return index, index_stats
+
+    def _build_response_payloads(self):
+        # payloads[tag][i] is the plain body; detail_prefixes[tag][i] is the
+        # body with intent filled in and the score left open to be appended
+        self.response_payloads = {}
+        self.response_detail_prefixes = {}
+        for tag, responses in self.intents_responses.items():
+            self.response_payloads[tag] = [
+                json.dumps({"response": r}).encode("utf-8") for r in responses
+            ]
+            self.response_detail_prefixes[tag] = [
+                (json.dumps({"response": r, "intent": tag})[:-1] + ', "score": ').encode("utf-8")
+                for r in responses
+            ]
 
     def _load_intents(self):
         intents_data = {
@@ -738,43 +1078,763 @@ class Chatbot:
         except:
             return "Internet connection required for this feature."
 
-    def process_message(self, message):
-        # Embed user message
-        input_embedding = self.embed_model.encode(message, convert_to_tensor=True)
-
-        # Compare with all intent patterns
-        best_tag = None
-        best_score = -1
-        for tag, embeddings in self.intent_embeddings.items():
-            # cosine similarity
-            scores = util.cos_sim(input_embedding, embeddings)
-            max_score = scores.max().item()
-            if max_score > best_score:
-                best_score = max_score
-                best_tag = tag
+    def _select_encoder(self, text):
+        if self.multilingual_model is None:
+            return self.embed_model, self.intent_index, False
+        try:
+            language = detect_language(text)
+        except Exception:
+            language = "en"
+        if language == "en":
+            return self.embed_model, self.intent_index, False
+        return self.multilingual_model, self.multilingual_index, True
+
+    def _segment(self, encoder, text):
+        # Inputs longer than the encoder window are split into sentences, and
+        # sentences still over the window into token chunks, so nothing is
+        # silently truncated. Only the first MAX_INPUT_SENTENCES segments are
+        # encoded; the rest are counted as dropped. Returns (segments, stats).
+        tokenizer = encoder.tokenizer
+        window = encoder.max_seq_length - 2  # room for [CLS]/[SEP]
+        stats = Counter()
+        if len(text) <= window:
+            # A subword piece covers at least one character, so short text
+            # fits and is not tokenized an extra time just to be measured
+            stats["short_inputs"] += 1
+            return [text], stats
+
+        sentences = [text]
+        ids = tokenizer([text], add_special_tokens=False)["input_ids"]
+        if len(ids[0]) > window:
+            sentences = split_sentences(text) or [text]
+            ids = tokenizer(sentences, add_special_tokens=False)["input_ids"]
+
+        segments = []
+        for sentence, sentence_ids in zip(sentences, ids):
+            if len(sentence_ids) <= window:
+                pieces = [(sentence, len(sentence_ids))]
+            else:
+                stats["chunked"] += 1
+                pieces = _chunk_tokens(tokenizer, sentence_ids, window)
+            for piece, token_count in pieces:
+                if len(segments) < MAX_INPUT_SENTENCES:
+                    segments.append(piece)
+                    stats["tokens"] += token_count + 2
+                else:
+                    stats["dropped_segments"] += 1
+                    stats["dropped_tokens"] += token_count
+        return segments, stats
+
+    def _record_input(self, message, segment_stats, segments, capped, multilingual):
+        with self._input_stats_lock:
+            self.input_stats["requests"] += 1
+            self.input_stats["chars"] += len(message)
+            self.input_stats["segments"] += segments
+            self.input_stats.update(segment_stats)
+            if capped:
+                self.input_stats["capped"] += 1
+            if segments > 1:
+                self.input_stats["split"] += 1
+            if segment_stats["dropped_segments"]:
+                self.input_stats["requests_with_dropped"] += 1
+            if multilingual:
+                self.input_stats["multilingual"] += 1
+
+    def input_status(self):
+        with self._input_stats_lock:
+            return dict(self.input_stats)
+
+    def cached_match(self, text):
+        # Cheap lookup used to route repeat questions around the encoder queue;
+        # text is the normalized form from prepare_message
+        with self._match_cache_lock:
+            match = self._match_cache.get(text)
+            if match is not None:
+                self._match_cache.move_to_end(text)
+            return match
+
+    def _remember_match(self, key, match):
+        if MATCH_CACHE_SIZE <= 0:
+            return
+        with self._match_cache_lock:
+            self._match_cache[key] = match
+            self._match_cache.move_to_end(key)
+            if len(self._match_cache) > MATCH_CACHE_SIZE:
+                self._match_cache.popitem(last=False)
+
+    def match_intent(self, message, prepared=None):
+        # prepared is the (text, capped) pair from prepare_message, when the
+        # caller has already normalized the message
+        text, capped = prepared if prepared is not None else prepare_message(message)
+        if not text:
+            return None, -1
+
+        # Embed user message (one row per segment)
+        encoder, index, multilingual = self._select_encoder(text)
+        segments, segment_stats = self._segment(encoder, text)
+        input_embedding = encoder.encode(segments)
+        self._record_input(message, segment_stats, len(segments), capped, multilingual)
+
+        # Compare with all intent patterns; the best segment/pattern pair wins
+        best_tag, best_score = index.search(input_embedding)
+
+        self._remember_match(text, (best_tag, best_score))
+        return best_tag, best_score
+
+    def answer(self, message, match=None):
+        # Returns (tag, score, response_index); response_index is None when
+        # the match is too weak and the caller should fall back
+        best_tag, best_score = match if match is not None else self.match_intent(message)
+        if best_score >= CONFIDENCE_THRESHOLD:
+            return best_tag, best_score, random.randrange(len(self.intents_responses[best_tag]))
+        return best_tag, best_score, None
+
+    def process_message(self, message, fallback=True):
+        tag, score, index = self.answer(message)
 
         # If similarity is high enough, return a response
-        if best_score >= 0.4:  # Adjusted threshold from 0.5 to 0.4
-            return random.choice(self.intents_responses[best_tag])
-        else:
+        if index is not None:
+            return self.intents_responses[tag][index]
+        elif fallback:
             # Fallback to internet or default answer
             return self.ask_llm(message)
+        return None
+
+    def _warmup_messages(self):
+        # Short, long-pattern and over-window inputs, so every encoder shape
+        # and the sentence-split path are exercised
+        patterns = [p for patterns_list in self.patterns.values() for p in patterns_list]
+        return [
+            min(patterns, key=len),
+            max(patterns, key=len),
+            ". ".join(patterns)[:MAX_INPUT_CHARS],
+        ]
+
+    def self_test(self):
+        # The first pattern of every intent must match its own intent above
+        # CONFIDENCE_THRESHOLD; returns the ones that do not
+        failures = []
+        for tag, patterns_list in self.patterns.items():
+            matched, score = self.match_intent(patterns_list[0])
+            if matched != tag or score < CONFIDENCE_THRESHOLD:
+                failures.append({"pattern": patterns_list[0], "expected": tag,
+                                 "matched": matched, "score": round(score, 4)})
+        return failures
+
+    def warm_up(self, rounds=WARMUP_ROUNDS):
+        # Runs encoder batches and the full matching path (no internet
+        # fallback) so lazy initialization happens before real traffic, then
+        # the self-test. Returns the self-test failures.
+        messages = self._warmup_messages()
+        encoders = [self.embed_model]
+        if self.multilingual_model is not None:
+            encoders.append(self.multilingual_model)
+
+        started = time.perf_counter()
+        round_timings = []
+        for _ in range(rounds):
+            round_started = time.perf_counter()
+            for encoder in encoders:
+                encoder.encode(messages)
+            batch_seconds = time.perf_counter() - round_started
+            for message in messages:
+                self.process_message(message, fallback=False)
+            round_timings.append({
+                "encode_batch": batch_seconds,
+                "process": time.perf_counter() - round_started - batch_seconds,
+            })
+
+        self.startup_timings["warmup"] = time.perf_counter() - started
+        self.startup_timings["warmup_rounds"] = round_timings
+
+        started = time.perf_counter()
+        failures = self.self_test()
+        self.startup_timings["self_test"] = time.perf_counter() - started
+
+        # Warm-up traffic should not show up in stats or occupy the cache
+        with self._input_stats_lock:
+            self.input_stats.clear()
+        with self._match_cache_lock:
+            self._match_cache.clear()
+        return failures
+
+    def response_payload(self, tag, index, score=None):
+        # Interned JSON body for a canned response, optionally with intent/score
+        if score is None:
+            return self.response_payloads[tag][index]
+        return self.response_detail_prefixes[tag][index] + ("%.4f}" % score).encode("utf-8")
+
+
+# =====================
+# HTTP HELPERS
+# =====================
+def _accepted_encodings():
+    accepted = set()
+    for part in request.headers.get("Accept-Encoding", "").split(","):
+        token, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0"):
+            continue
+        accepted.add(token.strip().lower())
+    return accepted
+
+
+def json_response(body, status=200):
+    # Large bodies (internet fallback answers) are compressed when the client allows it
+    response = Response(body, status=status, mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+    if len(body) < COMPRESSION_MIN_SIZE:
+        return response
+
+    accepted = _accepted_encodings()
+    if brotli is not None and "br" in accepted:
+        response.set_data(brotli.compress(body))
+        response.headers["Content-Encoding"] = "br"
+    elif "gzip" in accepted:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers["Content-Encoding"] = "gzip"
+    return response
+
+
+# =====================
+# ON-DEMAND PROFILING
+# =====================
+class RequestProfiler:
+    # Off by default: request handlers only check `active` before doing anything.
+    # "stacks" mode samples request threads and writes collapsed stacks
+    # (flamegraph.pl / speedscope input); "pstats" mode runs cProfile per request.
+
+    def __init__(self, output_dir, interval=0.005, slowest=20):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.slowest = slowest
+        self.active = False
+        self.last_report = None
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.mode = None
+        self.deadline = None
+        self.remaining_requests = None
+        self._threads = {}
+        self._stacks = Counter()
+        self._stats = None
+        self._slow = []
+        self._started_at = None
+        self._sampler = None
+
+    def start(self, seconds=None, requests=None, mode="stacks"):
+        if mode not in ("stacks", "pstats"):
+            raise ValueError("mode must be 'stacks' or 'pstats'")
+        if seconds is None and requests is None:
+            raise ValueError("either seconds or requests is required")
+        with self._lock:
+            if self.active:
+                return False
+            self._reset()
+            self.generation += 1
+            self.mode = mode
+            self._started_at = time.time()
+            if seconds is not None:
+                self.deadline = time.monotonic() + float(seconds)
+            if requests is not None:
+                self.remaining_requests = int(requests)
+            self.active = True
+        # The sampler thread also enforces the time limit in pstats mode
+        self._sampler = threading.Thread(target=self._sample_loop, args=(self.generation,),
+                                         name="request-profiler", daemon=True)
+        self._sampler.start()
+        return True
+
+    def begin(self):
+        # Called at the start of a request while active; returns a token for end()
+        if not self.active:
+            return None
+        token = {"start": time.perf_counter(), "profile": None}
+        if self.mode == "pstats":
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+                token["profile"] = profile
+            except ValueError:
+                # Python 3.12+ allows one active cProfile; overlapping requests go untraced
+                pass
+        else:
+            with self._lock:
+                self._threads[threading.get_ident()] = True
+        return token
+
+    def end(self, token, text_length, intent):
+        elapsed = time.perf_counter() - token["start"]
+        if token["profile"] is not None:
+            token["profile"].disable()
+        with self._lock:
+            self._threads.pop(threading.get_ident(), None)
+            if not self.active:
+                return
+            if token["profile"] is not None:
+                if self._stats is None:
+                    self._stats = pstats.Stats(token["profile"])
+                else:
+                    self._stats.add(token["profile"])
+            entry = (elapsed, text_length, intent)
+            if len(self._slow) < self.slowest:
+                heapq.heappush(self._slow, entry)
+            else:
+                heapq.heappushpop(self._slow, entry)
+            if self.remaining_requests is not None:
+                self.remaining_requests -= 1
+                if self.remaining_requests <= 0:
+                    self._finish_locked()
+
+    def stop(self):
+        with self._lock:
+            if self.active:
+                self._finish_locked()
+        return self.last_report
+
+    def status(self):
+        with self._lock:
+            return {
+                "active": self.active,
+                "mode": self.mode,
+                "remaining_requests": self.remaining_requests,
+                "seconds_left": None if self.deadline is None or not self.active
+                                else max(0.0, self.deadline - time.monotonic()),
+                "last_report": self.last_report,
+            }
+
+    def _sample_loop(self, generation):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                # A capture that ended and restarted within one interval
+                # belongs to a newer sampler; this one must not keep running
+                if not self.active or self.generation != generation:
+                    return
+                if self.deadline is not None and time.monotonic() >= self.deadline:
+                    self._finish_locked()
+                    return
+                if self.mode != "stacks" or not self._threads:
+                    continue
+                frames = sys._current_frames()
+                for ident in self._threads:
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        self._stacks[self._collapse(frame)] += 1
+
+    @staticmethod
+    def _collapse(frame):
+        parts = []
+        while frame is not None:
+            code = frame.f_code
+            parts.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        return ";".join(reversed(parts))
+
+    def _finish_locked(self):
+        self.active = False
+        os.makedirs(self.output_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self._started_at))
+        # PID and capture number keep same-second captures and workers sharing
+        # the output directory from overwriting each other
+        base = os.path.join(self.output_dir, "profile-%s-%d-%d" % (stamp, os.getpid(), self.generation))
+
+        if self.mode == "pstats":
+            profile_path = base + ".pstats"
+            if self._stats is not None:
+                self._stats.dump_stats(profile_path)
+            else:
+                profile_path = None
+        else:
+            profile_path = base + ".collapsed"
+            with open(profile_path, "w") as f:
+                for stack, count in self._stacks.most_common():
+                    f.write("%s %d\n" % (stack, count))
+
+        slowest = [
+            {"seconds": round(elapsed, 6), "text_length": length, "intent": intent}
+            for elapsed, length, intent in sorted(self._slow, reverse=True)
+        ]
+        with open(base + ".slowest.json", "w") as f:
+            json.dump(slowest, f, indent=2)
+
+        self.last_report = {
+            "mode": self.mode,
+            "profile": profile_path,
+            "slowest": base + ".slowest.json",
+            "slowest_requests": slowest,
+        }
+
+
+profiler = RequestProfiler(PROFILE_OUTPUT_DIR)
+
+
+_profile_signal_pending = False
+
+
+def _on_profile_signal(signum, frame):
+    # The signal may interrupt a thread holding the profiler lock, so the
+    # handler only sets a flag and the watcher thread starts the capture
+    global _profile_signal_pending
+    _profile_signal_pending = True
+
+
+def _watch_profile_signal():
+    global _profile_signal_pending
+    while True:
+        time.sleep(0.5)
+        if _profile_signal_pending:
+            _profile_signal_pending = False
+            profiler.start(seconds=PROFILE_SIGNAL_SECONDS)
+
+
+# Opt-in (PROFILE_SIGNAL=1) because servers such as gunicorn use SIGUSR1 themselves
+if PROFILE_SIGNAL and hasattr(signal, "SIGUSR1"):
+    try:
+        signal.signal(signal.SIGUSR1, _on_profile_signal)
+        threading.Thread(target=_watch_profile_signal, name="profile-signal", daemon=True).start()
+    except ValueError:
+        # Not the main thread (e.g. imported by some servers); endpoint still works
+        pass
+
+
+# =====================
+# RATE LIMITING AND FAIR SCHEDULING
+# =====================
+class InMemoryBucketStore:
+    # Token buckets for a single process. A bucket that has refilled to the
+    # burst is indistinguishable from a missing one, so those are pruned.
+
+    def __init__(self, prune_interval=RATE_LIMIT_PRUNE_INTERVAL):
+        self.prune_interval = prune_interval
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._last_prune = time.time()
+
+    def _prune_locked(self, rate, burst, now):
+        self._last_prune = now
+        full = [key for key, (tokens, updated) in self._buckets.items()
+                if tokens + (now - updated) * rate >= burst]
+        for key in full:
+            del self._buckets[key]
+
+    def take(self, key, rate, burst, now):
+        # Returns (allowed, retry_after_seconds)
+        with self._lock:
+            if now - self._last_prune >= self.prune_interval:
+                self._prune_locked(rate, burst, now)
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return True, 0.0
+            self._buckets[key] = (tokens, now)
+            return False, (1 - tokens) / rate
+
+
+class SqliteBucketStore:
+    # Same interface as InMemoryBucketStore, but buckets live in a SQLite file
+    # so every worker process on the host shares them. Local stand-in for a
+    # networked store such as Redis.
+
+    def __init__(self, path, prune_interval=RATE_LIMIT_PRUNE_INTERVAL):
+        self.path = path
+        self.prune_interval = prune_interval
+        self._local = threading.local()
+        self._last_prune = time.time()
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)"
+        )
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, rate, burst, now):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row is not None else (burst, now)
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                         (key, tokens, now))
+            if now - self._last_prune >= self.prune_interval:
+                # Any worker may prune; refilled buckets are the same as missing ones
+                self._last_prune = now
+                conn.execute("DELETE FROM buckets WHERE tokens + (? - updated) * ? >= ?", (now, rate, burst))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return (True, 0.0) if allowed else (False, (1 - tokens) / rate)
+
+
+class RateLimiter:
+
+    def __init__(self, store, rate, burst):
+        self.store = store
+        self.rate = rate
+        self.burst = burst
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+
+    def allow(self, client):
+        if self.rate <= 0:
+            return True, 0.0
+        allowed, retry_after = self.store.take(client, self.rate, self.burst, time.time())
+        with self._stats_lock:
+            self.stats["allowed" if allowed else "rejected"] += 1
+        return allowed, retry_after
+
+    def status(self):
+        with self._stats_lock:
+            return dict(self.stats)
+
+
+class FairScheduler:
+    # Bounds concurrent encoder calls. When all slots are busy, waiting
+    # requests are queued per client and slots are handed out round-robin
+    # across clients, so one busy client cannot starve the others.
+
+    def __init__(self, concurrency, max_queue_per_client, timeout):
+        self.concurrency = concurrency
+        self.max_queue_per_client = max_queue_per_client
+        self.timeout = timeout
+        self.stats = Counter()
+        self._cond = threading.Condition()
+        self._running = 0
+        self._queues = {}
+        self._rotation = deque()
+        self._granted = set()
+
+    def acquire(self, client):
+        # Returns False if the client's queue is full or the wait timed out
+        with self._cond:
+            if self._running < self.concurrency and not self._rotation:
+                self._running += 1
+                self.stats["admitted"] += 1
+                return True
+
+            queue = self._queues.setdefault(client, deque())
+            if len(queue) >= self.max_queue_per_client:
+                self.stats["rejected_queue_full"] += 1
+                return False
+            ticket = object()
+            queue.append(ticket)
+            if client not in self._rotation:
+                self._rotation.append(client)
+            self.stats["delayed"] += 1
+
+            deadline = time.monotonic() + self.timeout
+            while ticket not in self._granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    queue.remove(ticket)
+                    if not queue:
+                        del self._queues[client]
+                        self._rotation.remove(client)
+                    self.stats["rejected_timeout"] += 1
+                    return False
+                self._cond.wait(remaining)
+            self._granted.discard(ticket)
+            self.stats["admitted"] += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            if not self._rotation:
+                self._running -= 1
+                return
+            # Hand the slot straight to the next client in rotation
+            client = self._rotation.popleft()
+            queue = self._queues[client]
+            self._granted.add(queue.popleft())
+            if queue:
+                self._rotation.append(client)
+            else:
+                del self._queues[client]
+            self._cond.notify_all()
+
+    def record(self, name):
+        # Counters updated outside acquire/release (e.g. cache hits)
+        with self._cond:
+            self.stats[name] += 1
+
+    def status(self):
+        with self._cond:
+            status = dict(self.stats)
+            status["running"] = self._running
+            status["queued"] = sum(len(queue) for queue in self._queues.values())
+            return status
+
+
+if RATE_LIMIT_BACKEND == "sqlite":
+    rate_limiter = RateLimiter(SqliteBucketStore(RATE_LIMIT_SQLITE_PATH), RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST)
+else:
+    rate_limiter = RateLimiter(InMemoryBucketStore(), RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST)
+scheduler = FairScheduler(ENCODER_CONCURRENCY, CLIENT_QUEUE_DEPTH, QUEUE_TIMEOUT)
+
+
+def _client_id():
+    # Keyed on the caller's address only: client-supplied identifiers such as
+    # a session header could be rotated to get a fresh bucket and queue.
+    # remote_addr already reflects X-Forwarded-For when TRUSTED_PROXY_HOPS is set.
+    return "ip:" + (request.remote_addr or "unknown")
 
 
 app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = MAX_REQUEST_BYTES
+if TRUSTED_PROXY_HOPS > 0:
+    # Takes the client address added by the outermost trusted proxy, not the
+    # leftmost (client-controlled) X-Forwarded-For entry
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
 bot_assistant = Chatbot()
 
+# The warm-up ends with a readiness self-test: if it raises or a pattern does
+# not resolve to its own intent, /ready stays 503
+startup_report = {"ready": True}
+if WARMUP_ENABLED:
+    try:
+        self_test_failures = bot_assistant.warm_up()
+        if self_test_failures:
+            startup_report = {"ready": False, "self_test_failures": self_test_failures}
+    except Exception as e:
+        startup_report = {"ready": False, "error": repr(e)}
+startup_report["import"] = IMPORT_SECONDS
+startup_report.update(bot_assistant.startup_timings)
+startup_report["total"] = time.perf_counter() - _process_started
+# Whatever the named phases do not cover (app setup, payload building, ...)
+startup_report["other"] = startup_report["total"] - sum(
+    value for key, value in startup_report.items()
+    if isinstance(value, float) and key != "total"
+)
+print("Startup timings: " + json.dumps(startup_report))
+
+# The landing page only depends on the ngrok URL, so it is rendered once
+public_url_from_ngrok = '' # This will be replaced by the actual ngrok URL dynamically
+_index_page = None
+
+
+def _render_index_page():
+    global _index_page
+    if _index_page is None:
+        body = app.jinja_env.get_template('index.html').render(ngrok_url=public_url_from_ngrok).encode("utf-8")
+        _index_page = (body, hashlib.sha1(body).hexdigest())
+    return _index_page
+
+
 @app.route("/", methods=["GET"])
 def index():
-    # public_url_from_ngrok = 'https://handsomeish-earthly-yolanda.ngrok-free.dev/' # Placeholder, will be replaced or passed from run cell
-    public_url_from_ngrok = '' # This will be replaced by the actual ngrok URL dynamically
-    return render_template('index.html', ngrok_url=public_url_from_ngrok)
+    body, etag = _render_index_page()
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype="text/html")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "public, max-age=300"
+    return response
 
 @app.route("/chat", methods=["POST"])
 def chat():
     user_message = request.json.get("message")
-    if not user_message:
+    if not user_message or not isinstance(user_message, str):
         return jsonify({"error": "No message provided"}), 400
 
-    response = bot_assistant.process_message(user_message)
-    return jsonify({"response": response})
+    client = _client_id()
+    allowed, retry_after = rate_limiter.allow(client)
+    if not allowed:
+        response = jsonify({"error": "Rate limit exceeded"})
+        response.headers["Retry-After"] = str(max(1, int(retry_after + 0.999)))
+        return response, 429
+
+    details = bool(request.json.get("details"))
+    profile_token = profiler.begin() if profiler.active else None
+    outcome = "error"
+    try:
+        # Cache hits skip the encoder queue entirely
+        prepared = prepare_message(user_message)
+        match = bot_assistant.cached_match(prepared[0])
+        if match is None:
+            if not scheduler.acquire(client):
+                outcome = "rejected"
+                return jsonify({"error": "Server busy, try again shortly"}), 503
+            try:
+                match = bot_assistant.match_intent(user_message, prepared)
+            finally:
+                scheduler.release()
+        else:
+            scheduler.record("cache_hits")
+
+        tag, score, index = bot_assistant.answer(user_message, match)
+        if index is not None:
+            outcome = tag
+            body = bot_assistant.response_payload(tag, index, score if details else None)
+        else:
+            outcome = "fallback"
+            payload = {"response": bot_assistant.ask_llm(user_message)}
+            if details:
+                payload["intent"] = tag
+                payload["score"] = round(score, 4)
+            body = json.dumps(payload).encode("utf-8")
+        return json_response(body)
+    finally:
+        # Always unregister, or pstats mode would leave cProfile enabled
+        if profile_token is not None:
+            profiler.end(profile_token, len(user_message), outcome)
+
+@app.route("/ready", methods=["GET"])
+def ready():
+    if not startup_report["ready"]:
+        return jsonify(startup_report), 503
+    return jsonify(startup_report)
+
+def _admin_authorized():
+    # Admin routes are hidden unless PROFILE_ADMIN_TOKEN is configured
+    supplied = request.headers.get("X-Admin-Token", "")
+    return bool(PROFILE_ADMIN_TOKEN) and hmac.compare_digest(
+        supplied.encode("utf-8"), PROFILE_ADMIN_TOKEN.encode("utf-8"))
+
+@app.route("/admin/metrics", methods=["GET"])
+def admin_metrics():
+    if not _admin_authorized():
+        return jsonify({"error": "Not found"}), 404
+    return jsonify({
+        "rate_limit": rate_limiter.status(),
+        "scheduler": scheduler.status(),
+        "input_stats": bot_assistant.input_status(),
+        "index": bot_assistant.index_report,
+    })
+
+@app.route("/admin/profile", methods=["GET", "POST", "DELETE"])
+def admin_profile():
+    if not _admin_authorized():
+        return jsonify({"error": "Not found"}), 404
+
+    if request.method == "GET":
+        status = profiler.status()
+        status["input_stats"] = bot_assistant.input_status()
+        return jsonify(status)
+    if request.method == "DELETE":
+        return jsonify({"report": profiler.stop()})
+
+    options = request.get_json(silent=True) or {}
+    try:
+        started = profiler.start(
+            seconds=options.get("seconds"),
+            requests=options.get("requests"),
+            mode=options.get("mode", "stacks"),
+        )
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    if not started:
+        return jsonify({"error": "Profiling already active"}), 409
+    return jsonify(profiler.status()), 202